@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 
 import argparse
-import json
+import gzip
+import importlib.util
+import itertools
 import logging
+import os
 import sys
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, Any
 
 import numpy as np
 import pandas as pd
 from lxml import etree as ET
-from scipy.interpolate import interp1d
+
+try:
+    # orjson parses large MyWellness exports several times faster when present
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Set up logging
 logging.basicConfig(
@@ -28,15 +36,21 @@ TCD_NS_MAP = {
 
 AX_NS = {None: "http://www.garmin.com/xmlschemas/ActivityExtension/v2"}
 
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Workouts longer than this use the Numba distance kernels when available.
+# Set MYWELLNESS_BACKEND to "numba" or "numpy" to force either one.
+NUMBA_MIN_SAMPLES = 50_000
+
 
 def iso(dt: datetime) -> str:
-    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return dt.strftime(ISO_FORMAT)
 
 
 def load_json(in_file: str) -> Dict[str, Any]:
     try:
-        with open(in_file) as fp:
-            data = json.load(fp)
+        with open(in_file, "rb") as fp:
+            data = json_loads(fp.read())
         return data
     except Exception as e:
         logging.error(f"Error reading JSON file: {e}")
@@ -47,55 +61,119 @@ def process_samples(analitics: Dict[str, Any], start_dt: datetime) -> pd.DataFra
     logging.info("Processing samples array...")
     fields = [descriptor["pr"]["name"] for descriptor in analitics["descriptor"]]
 
-    samples = []
-    for sample in analitics["samples"]:
-        dt = start_dt + timedelta(seconds=sample["t"])
-        values = dict(zip(fields, sample["vs"]))
-        values["datetime"] = dt
-        values["interval"] = sample["t"]
-        samples.append(values)
-
-    df_samples = pd.DataFrame(samples)
+    samples = analitics["samples"]
+    count = len(samples)
+
+    # Speed stays float64: it is written to the TCX as m/s to one decimal, and
+    # float32 km/h values such as 26.1 would round the other way.
+    df_samples = pd.DataFrame(
+        {
+            field: np.fromiter(
+                (sample["vs"][k] for sample in samples),
+                dtype=np.float64 if field == "Speed" else np.float32,
+                count=count,
+            )
+            for k, field in enumerate(fields)
+        }
+    )
+    intervals = np.fromiter(
+        (sample["t"] for sample in samples), dtype=np.int64, count=count
+    )
+    df_samples["datetime"] = np.datetime64(start_dt, "s") + intervals.astype(
+        "timedelta64[s]"
+    )
+    df_samples["interval"] = intervals
 
-    while not df_samples.empty:
-        last_sample = df_samples.iloc[-1]
-        if last_sample["Speed"] != 0 or last_sample["Power"] != 0:
-            break
-        df_samples = df_samples[:-1]
+    # Drop the idle samples recorded after the workout ended.
+    active = (df_samples["Speed"].to_numpy() != 0) | (
+        df_samples["Power"].to_numpy() != 0
+    )
+    nonzero = np.flatnonzero(active)
+    if not len(nonzero):
+        logging.error("No samples with speed or power found")
+        sys.exit(1)
+    last = nonzero[-1] + 1
+    if last < len(df_samples):
+        df_samples = df_samples.iloc[:last]
 
     return df_samples
 
 
+def numba_kernels():
+    # Numba and llvmlite take a noticeable time to import, so they are only
+    # loaded once the Numba backend has been chosen.
+    from numba import njit
+
+    @njit(cache=True)
+    def distance_total(t_sec, speed):
+        total = 0.0
+        for i in range(1, len(speed)):
+            total += (t_sec[i] - t_sec[i - 1]) * speed[i] / 3.6
+        return total
+
+    @njit(cache=True)
+    def smooth_distance(t_sec, speed, first_dist, fact):
+        out = np.empty(len(speed))
+        dist = first_dist
+        out[0] = dist
+        for i in range(1, len(speed)):
+            dist += (t_sec[i] - t_sec[i - 1]) * speed[i] / 3.6 * fact
+            out[i] = dist
+        return out
+
+    return distance_total, smooth_distance
+
+
+def use_numba(n_samples: int) -> bool:
+    backend = os.environ.get("MYWELLNESS_BACKEND")
+    if backend == "numpy":
+        return False
+    if backend != "numba" and n_samples <= NUMBA_MIN_SAMPLES:
+        return False
+    if importlib.util.find_spec("numba") is None:
+        if backend == "numba":
+            logging.warning("Numba is not installed, using the NumPy backend")
+        return False
+    return True
+
+
 def calculate_distances(df_samples: pd.DataFrame) -> pd.DataFrame:
     logging.info("Calculating smoothed distances...")
     # Distances in HDistance are very inaccurate.  Loading them to Strava will
     # lead to calculated speed having interchanging 0 and 72 km/h values only
     # and sawtooth graph for it.
-    df_samples["SmoothDistance"] = df_samples["HDistance"].astype(float)
-    dist = df_samples["HDistance"].iloc[0]
-
-    for i in range(1, len(df_samples)):
-        delta_time = (
-            df_samples["datetime"].iloc[i] - df_samples["datetime"].iloc[i - 1]
-        ).seconds
-        dist += delta_time * df_samples["Speed"].iloc[i] / 3.6
-        df_samples.at[i, "SmoothDistance"] = dist
-        # print(df_samples.at[i, "HDistance"], df_samples.at[i, "SmoothDistance"])
-
-    fact = df_samples["HDistance"].iloc[-1] / dist
+    speed = df_samples["Speed"].to_numpy(dtype=np.float32, copy=False)
+    t_sec = (
+        df_samples["datetime"].to_numpy().astype("datetime64[s]").astype(np.int64)
+    )
+    first_dist = df_samples["HDistance"].iat[0]
+
+    numba_backend = use_numba(len(speed))
+
+    if numba_backend:
+        distance_total, smooth_distance = numba_kernels()
+        raw_total = distance_total(t_sec, speed)
+    else:
+        delta_time = np.empty(len(speed), dtype=np.float32)
+        delta_time[0] = 0
+        delta_time[1:] = np.diff(t_sec)
+        increments = delta_time * speed / np.float32(3.6)
+        raw_total = increments.sum(dtype=np.float64)
+
+    # The smoothed distance is linear in the increments, so the correction
+    # factor can be taken from their total before the cumulative pass.
+    fact = df_samples["HDistance"].iat[-1] / (first_dist + raw_total)
     logging.info(f"- distance correction factor is {fact}")
     assert 0.94 < fact < 1.06
 
-    dist = df_samples["HDistance"].iloc[0]
-    df_samples["SmoothDistance"] = float(dist)
-
-    for i in range(1, len(df_samples)):
-        delta_time = (
-            df_samples["datetime"].iloc[i] - df_samples["datetime"].iloc[i - 1]
-        ).seconds
-        dist += delta_time * df_samples["Speed"].iloc[i] / 3.6 * fact
-        df_samples.at[i, "SmoothDistance"] = dist
-        # print(df_samples.at[i, "HDistance"], df_samples.at[i, "SmoothDistance"])
+    if numba_backend:
+        smooth = smooth_distance(t_sec, speed, float(first_dist), fact)
+    else:
+        # Accumulate in float64: summing thousands of float32 increments would
+        # drift by metres over a long workout.
+        smooth = np.cumsum(increments * fact, dtype=np.float64)
+        smooth += first_dist
+    df_samples["SmoothDistance"] = smooth.astype(np.float32)
 
     return df_samples
 
@@ -104,20 +182,23 @@ def interpolate_heart_rates(
     analitics: Dict[str, Any], df_samples: pd.DataFrame
 ) -> pd.DataFrame:
     logging.info("Interpolating heart rates...")
-    hr_data = analitics["hr"]
-    hr_times = [hr["t"] for hr in hr_data]
-    hr_values = [hr["hr"] for hr in hr_data]
-
-    interpolation_function = interp1d(hr_times, hr_values, fill_value="extrapolate")
-    hr_intervals = np.arange(5, max(hr_times) + 1, 5)
-    interpolated_heart_rates = interpolation_function(hr_intervals)
-    interpolated_hr_data = {
-        int(interval): int(hr)
-        for interval, hr in zip(hr_intervals, interpolated_heart_rates)
-    }
-
-    df_samples["HeartRate"] = df_samples["interval"].map(interpolated_hr_data)
-    df_samples["HeartRate"] = df_samples["HeartRate"].ffill()
+    hr_data = analitics.get("hr") or []
+    if not hr_data:
+        # e.g. a ride without a chest strap; HeartRateBpm is left out of the TCX
+        logging.warning("No heart rate samples found")
+        return df_samples
+    if len(hr_data) == 1:
+        df_samples["HeartRate"] = np.int32(hr_data[0]["hr"])
+        return df_samples
+
+    hr_times = np.asarray([hr["t"] for hr in hr_data], dtype=np.float64)
+    hr_values = np.asarray([hr["hr"] for hr in hr_data], dtype=np.float64)
+
+    # Heart rates are sampled on their own clock, so interpolate them straight
+    # onto the sample intervals (np.interp clamps outside the recorded range).
+    intervals = df_samples["interval"].to_numpy()
+    heart_rates = np.interp(intervals, hr_times, hr_values)
+    df_samples["HeartRate"] = np.rint(heart_rates).astype(np.int32)
 
     return df_samples
 
@@ -129,8 +210,11 @@ def calculate_metrics(df_samples: pd.DataFrame) -> Dict[str, Any]:
     )
     total_distance_meters = df_samples["SmoothDistance"].iloc[-1]
     max_speed = df_samples["Speed"].max()
-    avg_heart_rate_bpm = df_samples["HeartRate"].mean()
-    max_heart_rate_bpm = df_samples["HeartRate"].max()
+    if "HeartRate" in df_samples:
+        avg_heart_rate_bpm = df_samples["HeartRate"].mean()
+        max_heart_rate_bpm = df_samples["HeartRate"].max()
+    else:
+        avg_heart_rate_bpm = max_heart_rate_bpm = None
 
     return {
         "total_time_seconds": total_time_seconds,
@@ -141,69 +225,121 @@ def calculate_metrics(df_samples: pd.DataFrame) -> Dict[str, Any]:
     }
 
 
+def text_element(tag: str, text: str):
+    element = ET.Element(tag)
+    element.text = text
+    return element
+
+
+def write_track(xf, df_samples: pd.DataFrame):
+    time_arr = df_samples["datetime"].dt.strftime(ISO_FORMAT).to_numpy()
+    # Format every numeric column to text up front so the loop below only
+    # assigns strings.
+    dist_arr = np.char.mod("%.1f", df_samples["SmoothDistance"].to_numpy())
+    has_hr = "HeartRate" in df_samples
+    if has_hr:
+        hr_arr = df_samples["HeartRate"].to_numpy().astype(int).astype(str)
+    else:
+        hr_arr = itertools.repeat(None)
+    rpm_arr = df_samples["Rpm"].to_numpy().round().astype(int).astype(str)
+    speed_arr = np.char.mod(
+        "%.1f", df_samples["Speed"].to_numpy(dtype=np.float64) / 3.6
+    )
+    power_arr = df_samples["Power"].to_numpy().round().astype(int).astype(str)
+
+    # Each trackpoint is serialized as soon as it is written, so a single
+    # element is reused for every sample and only its text is updated.
+    trackpoint = ET.Element("Trackpoint")
+    time_el = ET.SubElement(trackpoint, "Time")
+    dist_el = ET.SubElement(trackpoint, "DistanceMeters")
+    if has_hr:
+        heart_rate_bpm = ET.SubElement(trackpoint, "HeartRateBpm")
+        hr_el = ET.SubElement(heart_rate_bpm, "Value")
+    cadence_el = ET.SubElement(trackpoint, "Cadence")
+    extensions = ET.SubElement(trackpoint, "Extensions")
+    tpx = ET.SubElement(extensions, "TPX", nsmap=AX_NS)
+    speed_el = ET.SubElement(tpx, "Speed")
+    watts_el = ET.SubElement(tpx, "Watts")
+
+    with xf.element("Track"):
+        for time, dist, hr, rpm, speed, power in zip(
+            time_arr, dist_arr, hr_arr, rpm_arr, speed_arr, power_arr
+        ):
+            time_el.text = time
+            dist_el.text = dist
+            if has_hr:
+                hr_el.text = hr
+            cadence_el.text = rpm
+            speed_el.text = speed
+            watts_el.text = power
+            xf.write(trackpoint, pretty_print=True)
+
+
 def create_tcx(
     df_samples: pd.DataFrame, metrics: Dict[str, Any], start_dt: datetime, out_file: str
 ):
     logging.info("Creating TCX XML file...")
-    tcd = ET.Element("TrainingCenterDatabase", nsmap=TCD_NS_MAP)
-    activities = ET.SubElement(tcd, "Activities")
-    activity = ET.SubElement(activities, "Activity", Sport="Biking")
-    ET.SubElement(activity, "Id").text = iso(start_dt)
-    lap = ET.SubElement(activity, "Lap", StartTime=iso(start_dt))
-
-    ET.SubElement(lap, "TotalTimeSeconds").text = str(metrics["total_time_seconds"])
-    ET.SubElement(
-        lap, "DistanceMeters"
-    ).text = f"{metrics['total_distance_meters']:.1f}"
-    ET.SubElement(lap, "MaximumSpeed").text = f"{metrics['max_speed']:.1f}"
-    ET.SubElement(lap, "Calories").text = "0"
-    avg_hr = ET.SubElement(lap, "AverageHeartRateBpm")
-    ET.SubElement(avg_hr, "Value").text = f"{metrics['avg_heart_rate_bpm']:.0f}"
-    max_hr = ET.SubElement(lap, "MaximumHeartRateBpm")
-    ET.SubElement(max_hr, "Value").text = f"{metrics['max_heart_rate_bpm']:.0f}"
-    ET.SubElement(lap, "Intensity").text = "Active"
-    ET.SubElement(lap, "TriggerMethod").text = "Manual"
-
-    track = ET.SubElement(lap, "Track")
-
-    for _, sample in df_samples.iterrows():
-        trackpoint = ET.SubElement(track, "Trackpoint")
-        ET.SubElement(trackpoint, "Time").text = iso(sample["datetime"])
-        ET.SubElement(trackpoint, "DistanceMeters").text = str(
-            round(sample["SmoothDistance"], 1)
-        )
-        heart_rate_bpm = ET.SubElement(trackpoint, "HeartRateBpm")
-        ET.SubElement(heart_rate_bpm, "Value").text = str(int(sample["HeartRate"]))
-        ET.SubElement(trackpoint, "Cadence").text = str(sample["Rpm"])
-        extensions = ET.SubElement(trackpoint, "Extensions")
-        tpx = ET.SubElement(extensions, "TPX", nsmap=AX_NS)
-        ET.SubElement(tpx, "Speed").text = str(round(sample["Speed"] / 3.6, 1))
-        ET.SubElement(tpx, "Watts").text = str(sample["Power"])
-
-    xml_str = ET.tostring(
-        tcd, pretty_print=True, xml_declaration=True, encoding="utf-8"
-    )
-    with open(out_file, "wb") as f:
-        f.write(xml_str)
+    start_time = iso(start_dt)
+    lap_summary = [
+        text_element("TotalTimeSeconds", str(metrics["total_time_seconds"])),
+        text_element("DistanceMeters", f"{metrics['total_distance_meters']:.1f}"),
+        text_element("MaximumSpeed", f"{metrics['max_speed']:.1f}"),
+        text_element("Calories", "0"),
+    ]
+    if metrics["avg_heart_rate_bpm"] is not None:
+        avg_hr = ET.Element("AverageHeartRateBpm")
+        ET.SubElement(avg_hr, "Value").text = f"{metrics['avg_heart_rate_bpm']:.0f}"
+        max_hr = ET.Element("MaximumHeartRateBpm")
+        ET.SubElement(max_hr, "Value").text = f"{metrics['max_heart_rate_bpm']:.0f}"
+        lap_summary += [avg_hr, max_hr]
+    lap_summary += [
+        text_element("Intensity", "Active"),
+        text_element("TriggerMethod", "Manual"),
+    ]
+
+    # Stream the document to disk so only one trackpoint is held in memory at a
+    # time, instead of building and serializing the whole tree.  A ".gz" output
+    # is compressed on the way out, ready for upload to Strava as tcx.gz.
+    if out_file.endswith(".gz"):
+        out = gzip.open(out_file, "wb", compresslevel=6)
+    else:
+        out = open(out_file, "wb")
+
+    with out, ET.xmlfile(out, encoding="utf-8") as xf:
+        xf.write_declaration()
+        with xf.element("TrainingCenterDatabase", nsmap=TCD_NS_MAP):
+            with xf.element("Activities"):
+                with xf.element("Activity", Sport="Biking"):
+                    with xf.element("Id"):
+                        xf.write(start_time)
+                    with xf.element("Lap", StartTime=start_time):
+                        for summary in lap_summary:
+                            xf.write(summary, pretty_print=True)
+                        write_track(xf, df_samples)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert MyWellness JSON to TCX.")
     parser.add_argument("in_file", help="Input JSON file")
     parser.add_argument("start_dt", help="Start datetime in format YYYY-MM-DDTHH:MM")
+    parser.add_argument(
+        "--no-gzip",
+        action="store_true",
+        help="Write a plain .tcx file instead of a gzipped .tcx.gz",
+    )
     args = parser.parse_args()
 
     base_name = (
         args.in_file[:-5] if args.in_file.lower().endswith(".json") else args.in_file
     )
-    out_file = base_name + ".tcx"
+    out_file = base_name + (".tcx" if args.no_gzip else ".tcx.gz")
 
     start_dt = datetime.strptime(args.start_dt, "%Y-%m-%dT%H:%M")
 
     data = load_json(args.in_file)
     df_samples = process_samples(data["data"]["analitics"], start_dt)
-    df_samples = calculate_distances(df_samples)
     df_samples = interpolate_heart_rates(data["data"]["analitics"], df_samples)
+    df_samples = calculate_distances(df_samples)
     metrics = calculate_metrics(df_samples)
     create_tcx(df_samples, metrics, start_dt, out_file)
 
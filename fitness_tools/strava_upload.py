@@ -1,8 +1,10 @@
 from stravalib import Client
+import argparse
+import gzip
 import json
+import os
+import shutil
 import time
-import gzip
-import io
 
 
 def load_secrets(file_path):
@@ -16,6 +18,29 @@ def update_secrets(file_path, new_secrets):
         json.dump(new_secrets, file, indent=2)
 
 
+def gzip_tcx(tcx_path):
+    # Compress a plain .tcx file on disk, streaming through a small buffer
+    # rather than holding the whole file in memory
+    if tcx_path.endswith(".gz"):
+        return tcx_path
+
+    gz_path = tcx_path + ".gz"
+    with (
+        open(tcx_path, "rb") as src,
+        gzip.open(gz_path, "wb", compresslevel=6) as dst,
+    ):
+        shutil.copyfileobj(src, dst)
+    return gz_path
+
+
+def activity_name(tcx_path):
+    # "data/ride_20240614.tcx.gz" -> "ride_20240614"
+    name = os.path.basename(tcx_path)
+    for suffix in (".gz", ".tcx"):
+        name = name.removesuffix(suffix)
+    return name
+
+
 def check_and_refresh_access_token(secrets_file):
     secrets = load_secrets(secrets_file)
     client = Client()
@@ -44,39 +69,52 @@ def check_and_refresh_access_token(secrets_file):
         return secrets
 
 
-# Initialize the Strava client
-# secrets = load_secrets("config/secrets.json")
-
-secrets = check_and_refresh_access_token(
-    secrets_file="config/secrets.json",
-)
-print(secrets)
-
-client = Client(access_token=secrets["strava"]["access_token"])
-athlete = client.get_athlete()
-athlete_id = athlete.id
-
-stats = client.get_athlete_stats(athlete_id)
-print(stats)
-
-with open(file="data/mywellness_45m_20240614.tcx", mode="rb") as f:
-    file_content = f.read()
+def main():
+    parser = argparse.ArgumentParser(description="Upload a TCX file to Strava.")
+    parser.add_argument(
+        "tcx_file", help="TCX file to upload, plain (.tcx) or gzipped (.tcx.gz)"
+    )
+    parser.add_argument(
+        "--name", help="Activity title (defaults to the file name without extension)"
+    )
+    parser.add_argument("--description", help="Activity description")
+    args = parser.parse_args()
+
+    name = args.name or activity_name(args.tcx_file)
+
+    # Secrets are loaded once here and reused for the rest of the run
+    secrets = check_and_refresh_access_token(
+        secrets_file="config/secrets.json",
+    )
+    print(secrets)
+
+    # Initialize the Strava client
+    client = Client(access_token=secrets["strava"]["access_token"])
+    athlete = client.get_athlete()
+    athlete_id = athlete.id
+
+    stats = client.get_athlete_stats(athlete_id)
+    print(stats)
+
+    tcx_gz_path = gzip_tcx(args.tcx_file)
+
+    with open(file=tcx_gz_path, mode="rb") as f:
+        upload = client.upload_activity(
+            activity_file=f,
+            data_type="tcx.gz",
+            name=name,
+            description=args.description,
+            activity_type="ride",
+            private=False,
+            external_id="",
+            trainer=True,
+            commute=False,
+        )
 
-compressed_content = io.BytesIO()
-with gzip.GzipFile(fileobj=compressed_content, mode="wb") as gzip_file:
-    gzip_file.write(file_content)
+    # Block until Strava has processed the file so failures are reported here
+    activity = upload.wait()
+    print(f"Uploaded activity {activity.id}")
 
-compressed_content.seek(0)
-compressed_bytes_io = io.BytesIO(compressed_content.read())
 
-upload = client.upload_activity(
-    activity_file=compressed_bytes_io,
-    data_type="tcx.gz",
-    name="PTR010 - 45m effort",
-    description="Technogym",
-    activity_type="ride",
-    private=False,
-    external_id="",
-    trainer=True,
-    commute=False,
-)
+if __name__ == "__main__":
+    main()